@@ -1,64 +1,202 @@
 """Entry Point of the website"""
 
+import functools
+import hashlib
 import json
+import mimetypes
 import pathlib
-from typing import Optional
+from typing import Any, Callable, Iterable, Iterator, Optional, TypeVar
 
 import flask
-import flask_session
-import flask_sqlalchemy
-from src import db
+from src import db, recent
 from src import search as search_funcs
+from src import compress, session_store, sources
 
 app = flask.Flask(__name__, instance_path=str(pathlib.Path().absolute()))
 
-# Flask-Session setup
-flask_sql_db = flask_sqlalchemy.SQLAlchemy(model_class=db.Base)
 db.setup_db()
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///server.db"
-flask_sql_db.init_app(app)
-app.config["SESSION_TYPE"] = "sqlalchemy"
-app.config["SESSION_SQLALCHEMY"] = flask_sql_db
-flask_session.Session(app)
+session_store.init_app(app)
+compress.init_app(app)
 
 with open("src/filters.json", "r", encoding="utf-8") as f:
     filter_control = json.load(f)["filters"]
+# Registered sources missing from filters.json still get a source option
+for filter_option in filter_control:
+    if filter_option["name"] == "source":
+        listed = {option["id"] for option in filter_option["options"]}
+        filter_option["options"].extend(
+            {"id": key, "name": source.name}
+            for key, source in sources.registry.items()
+            if key not in listed
+        )
+
+# Fingerprinted builds of static files, made by scripts/build_static.py.
+# Without one, asset_url() links to the source files
+dist_dir = pathlib.Path(app.static_folder or "static", "dist")
+asset_manifest: dict[str, str] = {}
+if (dist_dir / "manifest.json").is_file():
+    with open(dist_dir / "manifest.json", "r", encoding="utf-8") as f:
+        asset_manifest = json.load(f)
+
+# Pages that only depend on filter_control and the login state are validated
+# with this, template mtimes, and logged_in. Asset URLs are in every page
+filters_digest: bytes = hashlib.sha256(
+    json.dumps([filter_control, asset_manifest], sort_keys=True).encode("utf-8")
+).digest()
+template_dir = pathlib.Path(app.root_path, app.template_folder or "templates")
+
+T = TypeVar("T")
+
+
+def with_db_session(view: Callable[..., T]) -> Callable[..., T]:
+    """Runs a view inside one db.session_scope(), so the db calls it makes
+    share a session instead of each opening their own"""
+
+    @functools.wraps(view)
+    def wrapper(*args: Any, **kwargs: Any) -> T:
+        with db.session_scope():
+            return view(*args, **kwargs)
+
+    return wrapper
+
+
+@app.after_request
+def validate_api_json(response: flask.Response) -> flask.Response:
+    """Gives GET /api/* JSON an ETag of its body, and turns the response into
+    a 304 when the client already has it"""
+    if (
+        flask.request.method == "GET"
+        and flask.request.path.startswith("/api/")
+        and response.status_code == 200
+        and response.mimetype == "application/json"
+        and not response.is_streamed
+    ):
+        response.add_etag()
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.make_conditional(flask.request)
+    return response
 
 
 @app.get("/")
 @app.get("/index.html")
+@with_db_session
 def index() -> str:
     """index.html for site"""
     user_id: Optional[int] = flask.session.get("user_id", None)
-    saved_items: Optional[list[dict[str, str | bool | int]]] = None if user_id is None else db.get_saved_items(user_id)
-    if saved_items is not None:
-        saved_items = saved_items[:20]
+    feed: dict[str, Optional[list[dict[str, str | bool | int]]]] = (
+        {} if user_id is None else db.get_home_feed(user_id)
+    )
     logged_in: bool = user_id is not None
     return flask.render_template(
         "index.html",
-        saved_items=saved_items,
-        recent_items=db.get_recently_viewed(user_id),
-        recent_search_items=db.get_recently_searched(user_id),
+        saved_items=feed.get("saved"),
+        recent_items=feed.get("recently_viewed"),
+        recent_search_items=feed.get("recently_searched"),
         logged_in=logged_in,
     )
 
 
+@app.template_global()
+def asset_url(filename: str) -> str:
+    """URL of a static file, pointing at its fingerprinted build if there is
+    one
+    filename(str): path under static/, such as js/main.js"""
+    if filename in asset_manifest:
+        return flask.url_for("built_asset", filename=asset_manifest[filename])
+    return flask.url_for("static", filename=filename)
+
+
+@app.template_global()
+def stylesheet_urls(*filenames: str) -> list[str]:
+    """URLs to link for a page's stylesheets: one built file with all of
+    them concatenated in order, or each file's own URL without a build
+    filenames(str): paths under static/, such as css/card.css"""
+    bundle: str = "+".join(filenames)
+    if bundle in asset_manifest:
+        return [flask.url_for("built_asset", filename=asset_manifest[bundle])]
+    return [asset_url(filename) for filename in filenames]
+
+
+@app.get("/static/dist/<path:filename>")
+def built_asset(filename: str) -> flask.Response:
+    """A fingerprinted static file. Its name changes with its content, so it
+    can be cached forever. Sent gzipped to clients that accept it"""
+    mimetype: Optional[str] = mimetypes.guess_type(filename)[0]
+    if (
+        flask.request.accept_encodings["gzip"]
+        and (dist_dir / f"{filename}.gz").is_file()
+    ):
+        response = flask.send_from_directory(
+            dist_dir, f"{filename}.gz", mimetype=mimetype
+        )
+        response.content_encoding = "gzip"
+    else:
+        response = flask.send_from_directory(dist_dir, filename, mimetype=mimetype)
+    response.vary.add("Accept-Encoding")
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = 31536000
+    response.cache_control.immutable = True
+    return response
+
+
+def page_etag(templates: Iterable[str], logged_in: bool) -> str:
+    """ETag of a page rendered from templates, filter_control and logged_in"""
+    digest = hashlib.sha256(filters_digest)
+    for name in templates:
+        mtime_ns = (template_dir / name).stat().st_mtime_ns
+        digest.update(f"{name}:{mtime_ns};".encode("utf-8"))
+    digest.update(b"logged_in" if logged_in else b"anonymous")
+    return digest.hexdigest()[:32]
+
+
+def conditional_page(
+    etag: str, logged_in: bool, render: Callable[[], str]
+) -> flask.Response:
+    """Answers a matching If-None-Match with 304, only calling render() when
+    the client's copy is out of date. Anonymous pages may be cached for a
+    while, logged in ones are revalidated on every load"""
+    if flask.request.if_none_match.contains_weak(etag):
+        response = flask.Response(status=304)
+    else:
+        response = flask.make_response(render())
+    response.set_etag(etag)
+    if logged_in:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    else:
+        response.cache_control.public = True
+        response.cache_control.max_age = 300
+    # The login state lives in the session cookie
+    response.vary.add("Cookie")
+    return response
+
+
 @app.get("/browse")
-def browse() -> str:
+def browse() -> flask.Response:
     """browse page for site"""
     logged_in: bool = flask.session.get("user_id", None) is not None
-    return flask.render_template(
-        "browse.html",
-        filters=filter_control,
-        logged_in=logged_in,
+    return conditional_page(
+        page_etag(("browse.html", "layout.html"), logged_in),
+        logged_in,
+        lambda: flask.render_template(
+            "browse.html",
+            filters=filter_control,
+            logged_in=logged_in,
+        ),
     )
 
 
 @app.get("/query")
-def query_page() -> str:
+def query_page() -> flask.Response:
     """ask question page for site"""
     logged_in: bool = flask.session.get("user_id", None) is not None
-    return flask.render_template("query.html", logged_in=logged_in)
+    return conditional_page(
+        page_etag(("query.html", "layout.html"), logged_in),
+        logged_in,
+        lambda: flask.render_template("query.html", logged_in=logged_in),
+    )
 
 
 @app.get("/saved")
@@ -66,12 +204,34 @@ def saved() -> str:
     """saved items page for site"""
     user_id: Optional[int] = flask.session.get("user_id", None)
     logged_in: bool = user_id is not None
-    saved_items = None if user_id is None else db.get_saved_items(user_id)
+    saved_items: Optional[list[dict[str, str | bool | int]]] = None
+    next_cursor: Optional[str] = None
+    if user_id is not None:
+        saved_items, next_cursor = db.get_saved_items_page(user_id)
     return flask.render_template(
-        "saved.html", saved_items=saved_items, logged_in=logged_in
+        "saved.html",
+        saved_items=saved_items,
+        next_cursor=next_cursor,
+        logged_in=logged_in,
     )
 
 
+@app.get("/api/saved")
+def saved_page() -> dict[str, bool | str | Optional[list[dict[str, str | bool | int]]]]:
+    """A page of saved items. Pass the next_cursor of one page as cursor to
+    get the one after it"""
+    try:
+        user_id: Optional[int] = flask.session.get("user_id", None)
+        if user_id is None:
+            return {"status": False, "error": "Login to see saved items"}
+        cursor: Optional[str] = flask.request.args.get("cursor", None)
+        limit: int = max(1, min(flask.request.args.get("limit", 20, type=int), 100))
+        items, next_cursor = db.get_saved_items_page(user_id, cursor or None, limit)
+        return {"status": True, "items": items, "next_cursor": next_cursor}
+    except ValueError as e:
+        return {"status": False, "error": str(e)}
+
+
 @app.post("/api/browse/search")
 def search() -> dict[str, bool | str | list[dict[str, str | bool | int]]]:
     user_id: Optional[int] = flask.session.get("user_id", None)
@@ -86,24 +246,77 @@ def search() -> dict[str, bool | str | list[dict[str, str | bool | int]]]:
     results: list[dict[str, str | bool | int]] = []
     if query == "":
         return {"status": True, "results": results}
-    match filters["source"]:
-        case "wikipedia":
-            results = search_funcs.wikipedia(query, num_results, user_id=user_id)
-        case "gbooks":
-            results = search_funcs.gbooks(query, num_results, filters, user_id=user_id)
-        case "openLib":
-            pass
-        case _:
-            raise ValueError("Source filter not in list of allowed values")
+    try:
+        if filters["source"] == "all":
+            results = search_funcs.all_sources(
+                query, num_results, filters, user_id=user_id
+            )
+        else:
+            results = search_funcs.search(
+                filters["source"], query, num_results, filters, user_id=user_id
+            )
+    except (sources.SourceUnavailable, ValueError) as e:
+        return {"status": False, "error": str(e)}
     return {"status": True, "results": results}
 
 
+@app.post("/api/browse/search/stream")
+def search_stream() -> flask.Response:
+    """Streams search results as NDJSON, one {"status", "item"} object per
+    line, so cards can be shown while slower sources are still working. A
+    line with status false and an error ends the stream early"""
+    user_id: Optional[int] = flask.session.get("user_id", None)
+    data = flask.request.json
+    if data is None:
+        return ndjson([{"status": False, "error": "No data provided"}])
+    filters: Optional[dict[str, str]] = data["filters"] if "filters" in data else None
+    if filters is None:
+        return ndjson([{"status": False, "error": "No filters provided"}])
+    num_results: int = min(data["num_results"], 20)
+    query: str = data["query"]
+    if query == "":
+        return ndjson([])
+    source_key: str = filters["source"]
+    # Checked before the stream has started, so it can't fail partway
+    try:
+        for source in (
+            sources.registry.values()
+            if source_key == "all"
+            else [sources.get(source_key)]
+        ):
+            source.check_filters(filters)
+    except ValueError as e:
+        return ndjson([{"status": False, "error": str(e)}])
+
+    def lines() -> Iterator[dict[str, bool | str | dict[str, str | bool | int]]]:
+        try:
+            for item in search_funcs.stream(
+                source_key, query, num_results, filters, user_id=user_id
+            ):
+                yield {"status": True, "item": item}
+        except Exception as e:
+            print(e)
+            yield {"status": False, "error": str(e)}
+
+    return ndjson(lines())
+
+
+def ndjson(
+    lines: Iterable[dict[str, bool | str | dict[str, str | bool | int]]],
+) -> flask.Response:
+    return flask.Response(
+        (json.dumps(line) + "\n" for line in lines),
+        mimetype="application/x-ndjson",
+    )
+
+
 @app.get("/api/oidc/redirect")
 def redirect() -> str:
     return flask.render_template("redirect.html")
 
 
 @app.post("/api/users/login")
+@with_db_session
 def send() -> dict[str, bool | str | Optional[list[dict[str, str | bool | int]]]]:
     try:
         data: Optional[dict[str, str | dict[str, str]]] = flask.request.json
@@ -131,22 +344,11 @@ def send() -> dict[str, bool | str | Optional[list[dict[str, str | bool | int]]]
         user = db.get_or_create_user(
             email, platform, platform_id, name=name, username=username
         )
-        app.session_interface.regenerate(flask.session)
+        session_store.regenerate()
         if not isinstance(user["id"], int):
             raise TypeError("User id somehow not an int")
         flask.session["user_id"] = user["id"]
-        try:
-            saved_items: Optional[list[dict[str, str | bool | int]]] = (
-                db.get_saved_items(user["id"])
-            )
-        except ValueError:
-            return {"status": False, "error": "Failed to properly login"}
-        return {
-            "status": True,
-            "saved": saved_items,
-            "recently_viewed": db.get_recently_viewed(user["id"]),
-            "recently_searched": db.get_recently_searched(user["id"]),
-        }
+        return {"status": True, **db.get_home_feed(user["id"])}
     except Exception as e:
         # Something bad happened
         print(e)
@@ -221,10 +423,9 @@ def add_to_recent_viewed() -> dict[str, bool | str]:
                 "status": False,
                 "error": "Provide an item_id to remember recent items",
             }
-        msg = db.append_to_recently_viewed(user_id, item_id)
-        if msg is None:
-            return {"status": True}
-        return {"status": False, "error": msg}
+        # Written in the background, with other views, by recent.views
+        recent.views.record(user_id, item_id)
+        return {"status": True}
     except Exception as e:
         return {"status": False, "error": str(e)}
 
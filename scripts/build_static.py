@@ -0,0 +1,198 @@
+"""Builds static/ into static/dist: content-hashed, minified files with
+precompressed .gz copies, and manifest.json mapping each source path to its
+build. Run it from the repository root after changing anything in static/
+
+Each stylesheet_urls() call in templates/ also gets its files concatenated
+into one stylesheet. JS is bundled and minified with esbuild, so the build
+fails without it on PATH. --unbundled skips it, fingerprinting each module
+as is with its imports rewritten to the hashed names"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import pathlib
+import re
+import shutil
+import subprocess
+import tempfile
+
+STATIC = pathlib.Path("static")
+DIST = STATIC / "dist"
+TEMPLATES = pathlib.Path("templates")
+# Built files worth compressing. Images like PNGs already are
+COMPRESSIBLE = {".js", ".css", ".svg"}
+# Strings and comments, so comments can be dropped without touching strings
+CSS_TOKENS = re.compile(r"(\"(?:[^\"\\]|\\.)*\"|'(?:[^'\\]|\\.)*')|/\*.*?\*/", re.S)
+CSS_STRINGS = re.compile(r"(\"(?:[^\"\\]|\\.)*\"|'(?:[^'\\]|\\.)*')")
+JS_IMPORT = re.compile(r"""(\bfrom\s*|\bimport\s*\(?\s*)(["'])\./([\w.-]+\.js)\2""")
+STYLESHEET_CALL = re.compile(r"stylesheet_urls\(([^)]*)\)")
+QUOTED = re.compile(r"""(["'])(.*?)\1""")
+
+
+def fingerprint(path: pathlib.Path, data: bytes) -> pathlib.Path:
+    """path with a hash of data before its extension, e.g. js/card.1a2b3c4d.js"""
+    digest = hashlib.sha256(data).hexdigest()[:10]
+    return path.with_name(f"{path.stem}.{digest}{path.suffix}")
+
+
+def write(relative: pathlib.Path, data: bytes) -> None:
+    target = DIST / relative
+    target.parent.mkdir(parents=True, exist_ok=True)
+    target.write_bytes(data)
+    if target.suffix in COMPRESSIBLE:
+        # mtime=0 keeps the .gz identical between builds of the same file
+        target.with_name(target.name + ".gz").write_bytes(
+            gzip.compress(data, compresslevel=9, mtime=0)
+        )
+
+
+def minify_css(css: str) -> str:
+    """Drops comments and whitespace that can't change what the CSS means.
+    Strings are left alone"""
+    # A comment can separate two tokens, so it becomes a space
+    css = CSS_TOKENS.sub(lambda match: match.group(1) or " ", css)
+    # Odd parts are the strings
+    parts = CSS_STRINGS.split(css)
+    return "".join(
+        part if i % 2 else squeeze_css(part) for i, part in enumerate(parts)
+    ).strip()
+
+
+def squeeze_css(css: str) -> str:
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r" ?([{};,>]) ?", r"\1", css)
+    return css.replace(";}", "}")
+
+
+def build_css(manifest: dict[str, str]) -> None:
+    minified: dict[str, str] = {}
+    for path in sorted((STATIC / "css").glob("*.css")):
+        source = path.relative_to(STATIC).as_posix()
+        minified[source] = minify_css(path.read_text(encoding="utf-8"))
+        data = minified[source].encode("utf-8")
+        relative = fingerprint(path.relative_to(STATIC), data)
+        write(relative, data)
+        manifest[source] = relative.as_posix()
+    for files in stylesheet_bundles():
+        data = "\n".join(minified[name] for name in files).encode("utf-8")
+        relative = fingerprint(pathlib.Path("css", "bundle.css"), data)
+        write(relative, data)
+        manifest["+".join(files)] = relative.as_posix()
+
+
+def stylesheet_bundles() -> set[tuple[str, ...]]:
+    """The files of every stylesheet_urls() call with more than one, in the
+    order a page links them"""
+    bundles: set[tuple[str, ...]] = set()
+    for path in sorted(TEMPLATES.rglob("*.html")):
+        for call in STYLESHEET_CALL.finditer(path.read_text(encoding="utf-8")):
+            files = tuple(match.group(2) for match in QUOTED.finditer(call.group(1)))
+            if len(files) > 1:
+                bundles.add(files)
+    return bundles
+
+
+def build_js_esbuild(esbuild: str, manifest: dict[str, str]) -> None:
+    """Bundles each module with esbuild. Code they share, like card.js, is
+    split into a chunk they all import, so it still runs once per page"""
+    entries = sorted((STATIC / "js").glob("*.js"))
+    with tempfile.TemporaryDirectory() as out:
+        meta = pathlib.Path(out, "meta.json")
+        subprocess.run(
+            [
+                esbuild,
+                *map(str, entries),
+                "--bundle",
+                "--splitting",
+                "--format=esm",
+                "--minify",
+                f"--outdir={out}/js",
+                "--entry-names=[name].[hash]",
+                "--chunk-names=chunk.[hash]",
+                f"--metafile={meta}",
+            ],
+            check=True,
+        )
+        outputs = json.loads(meta.read_text(encoding="utf-8"))["outputs"]
+        for output, info in outputs.items():
+            # Output paths are relative to the working directory
+            built = pathlib.Path(output).resolve()
+            relative = built.relative_to(pathlib.Path(out).resolve())
+            write(relative, built.read_bytes())
+            if "entryPoint" in info:
+                source = pathlib.Path(info["entryPoint"]).relative_to(STATIC)
+                manifest[source.as_posix()] = relative.as_posix()
+
+
+def build_js_fingerprint(manifest: dict[str, str]) -> None:
+    """Fingerprints each module, dependencies first, so a change to card.js
+    also changes the names of the modules importing it"""
+    sources = {
+        path.name: path.read_text(encoding="utf-8")
+        for path in (STATIC / "js").glob("*.js")
+    }
+    built: dict[str, str] = {}
+
+    def build(name: str, importing: tuple[str, ...]) -> str:
+        if name in built:
+            return built[name]
+        if name in importing:
+            raise ValueError(f"Import cycle through js/{name}")
+
+        def rewrite(match: re.Match[str]) -> str:
+            dependency = build(match.group(3), (*importing, name))
+            return f"{match.group(1)}{match.group(2)}./{dependency}{match.group(2)}"
+
+        data = JS_IMPORT.sub(rewrite, sources[name]).encode("utf-8")
+        relative = fingerprint(pathlib.Path("js", name), data)
+        write(relative, data)
+        built[name] = relative.name
+        manifest[f"js/{name}"] = relative.as_posix()
+        return relative.name
+
+    for name in sorted(sources):
+        build(name, ())
+
+
+def build_other(manifest: dict[str, str]) -> None:
+    for path in sorted((STATIC / "img").rglob("*")):
+        if path.is_file():
+            data = path.read_bytes()
+            relative = fingerprint(path.relative_to(STATIC), data)
+            write(relative, data)
+            manifest[path.relative_to(STATIC).as_posix()] = relative.as_posix()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Build static/ into static/dist")
+    parser.add_argument(
+        "--unbundled",
+        action="store_true",
+        help="fingerprint JS modules without bundling or minifying them",
+    )
+    args = parser.parse_args()
+    # Cleared first, so a failed build can't leave an old manifest to serve
+    if DIST.exists():
+        shutil.rmtree(DIST)
+    esbuild = shutil.which("esbuild")
+    if esbuild is None and not args.unbundled:
+        raise SystemExit(
+            "esbuild is needed to bundle and minify JS. Install it, or pass"
+            " --unbundled to fingerprint the modules as they are"
+        )
+    manifest: dict[str, str] = {}
+    build_css(manifest)
+    if esbuild is not None and not args.unbundled:
+        build_js_esbuild(esbuild, manifest)
+    else:
+        build_js_fingerprint(manifest)
+    build_other(manifest)
+    (DIST / "manifest.json").write_text(
+        json.dumps(manifest, indent=4, sort_keys=True), encoding="utf-8"
+    )
+    print(f"Built {len(manifest)} files into {DIST}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,11 @@
 #!/bin/bash
+set -e
 
 source venv/bin/activate
-python app.py
+if command -v esbuild > /dev/null; then
+    python scripts/build_static.py
+else
+    echo "esbuild not found, so JS is fingerprinted but not bundled or minified"
+    python scripts/build_static.py --unbundled
+fi
+python serve.py "$@"
@@ -0,0 +1,88 @@
+"""Production entry point, serving the website from preforked gunicorn workers
+
+SIGHUP gracefully replaces the workers and SIGTERM shuts down once in-flight
+requests finish. The app is loaded once before forking, so code changes
+need SIGUSR2 (a new master) or a restart rather than SIGHUP"""
+
+import argparse
+import os
+from typing import Any, Optional
+
+from gunicorn.app import base
+
+from app import app
+from src import db, recent
+
+
+def post_fork(server: Any, worker: Any) -> None:
+    # Pooled connections opened by the master must not be shared
+    db.dispose_engines()
+    if "sqlalchemy" in app.extensions:
+        with app.app_context():
+            for engine in app.extensions["sqlalchemy"].engines.values():
+                engine.dispose(close=False)
+
+
+def worker_exit(server: Any, worker: Any) -> None:
+    recent.views.flush()
+
+
+class Server(base.BaseApplication):
+    """gunicorn application serving app
+    options(dict[str, Any]): gunicorn settings, such as bind and workers"""
+
+    def __init__(self, options: Optional[dict[str, Any]] = None) -> None:
+        self.options = options or {}
+        super().__init__()
+
+    def load_config(self) -> None:
+        for key, value in self.options.items():
+            if key in self.cfg.settings and value is not None:
+                self.cfg.set(key, value)
+
+    def load(self) -> Any:
+        return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve WebLib with gunicorn")
+    parser.add_argument(
+        "--bind", default=os.environ.get("BIND", "127.0.0.1:8010"), help="host:port"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        help="worker processes",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=int(os.environ.get("WEB_THREADS", 4)),
+        help="request threads per worker",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=int,
+        default=30,
+        help="seconds a request may run, and graceful shutdown waits",
+    )
+    args = parser.parse_args()
+    Server(
+        {
+            "bind": args.bind,
+            "workers": args.workers,
+            "threads": args.threads,
+            "worker_class": "gthread",
+            "timeout": args.timeout,
+            "graceful_timeout": args.timeout,
+            "preload_app": True,
+            "post_fork": post_fork,
+            "worker_exit": worker_exit,
+            "accesslog": "-",
+        }
+    ).run()
+
+
+if __name__ == "__main__":
+    main()
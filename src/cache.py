@@ -0,0 +1,133 @@
+"""Bounded in-process caches"""
+
+import threading
+import time
+from concurrent import futures
+from typing import Callable, Generic, Hashable, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class Entry(Generic[V]):
+    __slots__ = ("value", "expires", "refreshing")
+
+    def __init__(self, value: V, expires: float) -> None:
+        self.value = value
+        self.expires = expires
+        self.refreshing = False
+
+
+class TTLCache(Generic[K, V]):
+    """LRU cache whose entries expire after ttl seconds. For stale_ttl
+    seconds after that, get_or_load() still returns the old value while a
+    refresh runs in the background on executor
+    max_size(int): entries kept before the least recently used is evicted
+    ttl(float): seconds an entry is served as fresh
+    stale_ttl(float): extra seconds an expired entry may be served while
+    it is revalidated
+    executor(Executor | None): where background refreshes run. Without
+    one, stale entries are treated as misses"""
+
+    def __init__(
+        self,
+        max_size: int = 256,
+        ttl: float = 300.0,
+        stale_ttl: float = 0.0,
+        *,
+        executor: Optional[futures.Executor] = None,
+    ) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.executor = executor
+        self._entries: dict[K, Entry[V]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: K) -> Optional[V]:
+        """Returns the fresh value for key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.expires <= time.monotonic():
+                self.misses += 1
+                return None
+            self._touch(key, entry)
+            self.hits += 1
+            return entry.value
+
+    def get_or_load(self, key: K, loader: Callable[[], V]) -> V:
+        """Returns the cached value for key, calling loader() to fill it on
+        a miss, or in the background once the entry has gone stale"""
+        with self._lock:
+            entry = self._entries.get(key)
+            now = time.monotonic()
+            if entry is not None and now < entry.expires:
+                self._touch(key, entry)
+                self.hits += 1
+                return entry.value
+            if (
+                entry is not None
+                and self.executor is not None
+                and now < entry.expires + self.stale_ttl
+            ):
+                self._touch(key, entry)
+                self.stale_hits += 1
+                if not entry.refreshing:
+                    entry.refreshing = True
+                    self.executor.submit(self._refresh, key, loader, entry)
+                return entry.value
+            self.misses += 1
+        value = loader()
+        self.set(key, value)
+        return value
+
+    def set(self, key: K, value: V) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = Entry(value, time.monotonic() + self.ttl)
+            while len(self._entries) > self.max_size:
+                # Dicts keep insertion order, and _touch re-inserts on use
+                del self._entries[next(iter(self._entries))]
+                self.evictions += 1
+
+    def invalidate(self, key: K) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict[str, int | float]:
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (
+                    (self.hits + self.stale_hits) / lookups if lookups else 0.0
+                ),
+            }
+
+    def _touch(self, key: K, entry: Entry[V]) -> None:
+        del self._entries[key]
+        self._entries[key] = entry
+
+    def _refresh(self, key: K, loader: Callable[[], V], entry: Entry[V]) -> None:
+        try:
+            self.set(key, loader())
+        except Exception as e:
+            print(e)
+            with self._lock:
+                entry.refreshing = False
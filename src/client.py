@@ -0,0 +1,102 @@
+"""Process-wide pooled HTTP client shared by the upstream search sources"""
+
+import os
+import threading
+from typing import Any, Optional
+
+import requests
+from requests import adapters
+from urllib3 import util
+
+# "gzip" in the UA is what Google asks for before it will compress responses
+USER_AGENT = "WebLib/1.0 (https://github.com/lvoz2/weblib) (gzip)"
+
+
+class Client:
+    """Keeps one requests.Session per process, so connections to each
+    upstream host stay alive between searches instead of paying for a new
+    TCP and TLS handshake on every call
+    pool_connections(int): how many hosts to keep a pool for
+    pool_maxsize(int): keep-alive connections kept per host
+    retries(int): retries on connection errors and 429/5xx responses. Read
+    timeouts are not retried
+    backoff_factor(float): base of the exponential delay between retries"""
+
+    def __init__(
+        self,
+        *,
+        pool_connections: int = 8,
+        pool_maxsize: int = 16,
+        retries: int = 2,
+        backoff_factor: float = 0.25,
+    ) -> None:
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self._lock = threading.Lock()
+        self._session: Optional[requests.Session] = None
+        self._pid: Optional[int] = None
+
+    def configure(self, **kwargs: Any) -> None:
+        """Changes pool or retry settings, taking effect on the next request"""
+        with self._lock:
+            for key, value in kwargs.items():
+                if not hasattr(self, key) or key.startswith("_"):
+                    raise ValueError(f"Unknown client setting {key}")
+                setattr(self, key, value)
+            self._close()
+
+    @property
+    def session(self) -> requests.Session:
+        with self._lock:
+            # Pooled sockets can't be shared with a forked child
+            if self._session is None or self._pid != os.getpid():
+                self._session = self._build()
+                self._pid = os.getpid()
+            return self._session
+
+    def get(self, url: str, *, timeout: float, **kwargs: Any) -> requests.Response:
+        return self.session.get(url, timeout=timeout, **kwargs)
+
+    def head(self, url: str, *, timeout: float, **kwargs: Any) -> requests.Response:
+        return self.session.head(url, timeout=timeout, **kwargs)
+
+    def close(self) -> None:
+        with self._lock:
+            self._close()
+
+    def _close(self) -> None:
+        if self._session is not None and self._pid == os.getpid():
+            self._session.close()
+        self._session = None
+        self._pid = None
+
+    def _build(self) -> requests.Session:
+        retry = util.Retry(
+            total=self.retries,
+            # A read timeout already used the caller's whole timeout, so
+            # retrying it would multiply how long a search waits
+            read=0,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset({"GET", "HEAD"}),
+            # Retry-After can ask for hours, slept while a source slot and a
+            # worker thread are held. The backoff keeps retries well inside
+            # the caller's timeout instead
+            respect_retry_after_header=False,
+            raise_on_status=False,
+        )
+        adapter = adapters.HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            max_retries=retry,
+        )
+        session = requests.Session()
+        session.headers["User-Agent"] = USER_AGENT
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+
+client = Client()
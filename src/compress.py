@@ -0,0 +1,61 @@
+"""Gzips responses for clients that accept it"""
+
+import gzip
+
+import flask
+
+# Types that shrink well. Images and fonts are already compressed
+COMPRESSIBLE_TYPES = {
+    "application/json",
+    "application/javascript",
+    "image/svg+xml",
+    "text/css",
+    "text/html",
+    "text/javascript",
+    "text/plain",
+}
+
+
+def init_app(app: flask.Flask) -> None:
+    """Compresses app's responses after every other after_request hook has
+    run. COMPRESS_LEVEL (1-9) trades CPU for size, and bodies smaller than
+    COMPRESS_MIN_SIZE bytes are sent as they are"""
+    app.config.setdefault("COMPRESS_LEVEL", 6)
+    app.config.setdefault("COMPRESS_MIN_SIZE", 500)
+    # after_request hooks run last registered first, so register before routes
+    app.after_request(compress)
+
+
+def compress(response: flask.Response) -> flask.Response:
+    if response.mimetype not in COMPRESSIBLE_TYPES:
+        return response
+    response.vary.add("Accept-Encoding")
+    if (
+        # Streamed bodies must reach the client as they are produced, and
+        # passthrough ones are files sent as they are
+        response.is_streamed
+        or response.direct_passthrough
+        or response.content_encoding is not None
+        or response.status_code < 200
+        or response.status_code in (204, 304)
+        or response.cache_control.no_transform
+        or not flask.request.accept_encodings["gzip"]
+    ):
+        return response
+    data = response.get_data()
+    if len(data) < flask.current_app.config["COMPRESS_MIN_SIZE"]:
+        return response
+    compressed = gzip.compress(
+        data, compresslevel=flask.current_app.config["COMPRESS_LEVEL"]
+    )
+    if len(compressed) >= len(data):
+        return response
+    response.set_data(compressed)
+    response.content_encoding = "gzip"
+    # The bytes differ from the uncompressed ETag's, but they mean the same,
+    # which is what a weak ETag says. If-None-Match compares weakly, so 304s
+    # still match either form
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,128 @@
+"""Works out thumbnail MIME types without probing every image upstream"""
+
+import mimetypes
+import os
+import queue
+import threading
+from typing import Optional
+from urllib import parse
+
+from src import cache, client, db
+
+# Hosts whose image URLs carry no usable extension, but always serve one type
+CDN_TYPES: dict[str, str] = {
+    "books.google.com": "image/jpeg",
+    "books.googleusercontent.com": "image/jpeg",
+}
+# Hosts whose final path segment reliably names the served format, including
+# rendered thumbnails such as ".../200px-Example.svg.png"
+CDN_EXTENSION_HOSTS: set[str] = {"upload.wikimedia.org"}
+
+
+def guess(url: str) -> Optional[str]:
+    """Infers the MIME type of an image from its URL alone
+    url(str): the image URL
+    Returns None when the type can't be worked out without asking the host"""
+    if url == "":
+        return ""
+    parts = parse.urlsplit(url)
+    host = (parts.hostname or "").lower()
+    if host in CDN_TYPES:
+        return CDN_TYPES[host]
+    last_segment = parts.path.rsplit("/", 1)[-1]
+    mime, _ = mimetypes.guess_type(last_segment, strict=False)
+    if mime is not None and mime.startswith("image/"):
+        return mime
+    if host in CDN_EXTENSION_HOSTS and mime is not None:
+        return mime
+    return None
+
+
+class Resolver:
+    """Background worker that probes the thumbnails guess() couldn't place,
+    and fills in Item.thumb_mime once the answer comes back
+    max_pending(int): probes queued before submit() turns more away
+    timeout(float): seconds each probe may take
+    max_attempts(int): failed probes of an item before it is left blank
+    retry_after(float): seconds until an item given up on may be tried again"""
+
+    def __init__(
+        self,
+        max_pending: int = 256,
+        timeout: float = 5.0,
+        max_attempts: int = 3,
+        retry_after: float = 86400.0,
+    ) -> None:
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        # Failed probes per item, so one that never answers isn't probed on
+        # every lookup
+        self._failures: cache.TTLCache[int, int] = cache.TTLCache(
+            max_size=4096, ttl=retry_after
+        )
+        self._queue: queue.Queue[tuple[int, str]] = queue.Queue(max_pending)
+        # Items queued or being probed, so repeat lookups don't queue them twice
+        self._queued: set[int] = set()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+
+    def should_probe(self, item_id: int) -> bool:
+        """False once item_id's probes have failed max_attempts times, until
+        retry_after seconds after the last failure"""
+        return (self._failures.get(item_id) or 0) < self.max_attempts
+
+    def submit(self, item_id: int, url: str) -> bool:
+        """Queues item_id's thumbnail to be probed, unless it already is.
+        Returns False if the queue is full or the item has been given up on,
+        leaving thumb_mime blank"""
+        if not self.should_probe(item_id):
+            return False
+        self._ensure_started()
+        with self._lock:
+            if item_id in self._queued:
+                return True
+            try:
+                self._queue.put_nowait((item_id, url))
+            except queue.Full:
+                return False
+            self._queued.add(item_id)
+        return True
+
+    def probe(self, url: str) -> str:
+        res = client.client.head(url, timeout=self.timeout)
+        return res.headers.get("content-type", "").split(";")[0].strip()
+
+    def _ensure_started(self) -> None:
+        # Threads don't survive a fork, so each process starts its own
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue(self._queue.maxsize)
+            self._queued = set()
+            self._thread = threading.Thread(
+                target=self._run, name="weblib-mime", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            item_id, url = self._queue.get()
+            found = False
+            try:
+                mime = self.probe(url)
+                if mime != "":
+                    db.set_thumb_mime(item_id, mime)
+                    found = True
+            except Exception as e:
+                print(e)
+            finally:
+                if not found:
+                    self._failures.set(item_id, (self._failures.get(item_id) or 0) + 1)
+                with self._lock:
+                    self._queued.discard(item_id)
+                self._queue.task_done()
+
+
+resolver = Resolver()
@@ -0,0 +1,75 @@
+"""Buffers recently viewed events so requests don't wait on a database write"""
+
+import atexit
+import os
+import threading
+import time
+from typing import Optional
+
+from src import db
+
+
+class ViewBuffer:
+    """Write-behind buffer for recently viewed events. Repeat views of an
+    item by the same user are coalesced to the latest, and a background
+    thread writes everything pending in one transaction every interval
+    max_pending(int): events held before record() flushes them itself
+    interval(float): seconds between background flushes"""
+
+    def __init__(self, max_pending: int = 1024, interval: float = 1.0) -> None:
+        self.max_pending = max_pending
+        self.interval = interval
+        self._pending: dict[tuple[int, int], int] = {}
+        self._lock = threading.Lock()
+        # Only one flush writes at a time, so batches land in order
+        self._flush_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def record(self, user_id: int, item_id: int) -> None:
+        """Queues a view of item_id by user_id, timed now"""
+        self._ensure_started()
+        with self._lock:
+            key = (user_id, item_id)
+            # Re-insert so a repeat view moves to the end of the batch
+            self._pending.pop(key, None)
+            self._pending[key] = db.current_time()
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes every pending event now"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            try:
+                db.record_recently_viewed(batch)
+            except Exception as e:
+                print(e)
+
+    def _ensure_started(self) -> None:
+        # Threads don't survive a fork, so each process starts its own
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            # Events buffered by the parent are its to write
+            self._pending = {}
+            self._thread = threading.Thread(
+                target=self._run, name="weblib-recent", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+
+views = ViewBuffer()
+# Daemon threads are killed at exit, so write what is left first
+atexit.register(views.flush)
@@ -1,21 +1,182 @@
 """Collection of functions to search various 3rd-party sites"""
 
-from typing import Optional
+import contextvars
+import queue
+import time
+from concurrent import futures
+from typing import Any, Callable, Iterator, Optional
 from urllib import parse
 
-import requests
-from src import db
+from src import cache, client, db, mime, sources
 
+# Shared, bounded pool for independent upstream calls, so a search waits on
+# the slowest request rather than the sum of all of them
+executor = futures.ThreadPoolExecutor(
+    max_workers=16, thread_name_prefix="weblib-search"
+)
+# Whole-source searches get their own pool, as they wait on calls sent to
+# executor and sharing one pool could starve it
+source_executor = futures.ThreadPoolExecutor(
+    max_workers=8, thread_name_prefix="weblib-source"
+)
+# Background refreshes of stale results. They wait on calls sent to executor
+# too, so they can't share it or source_executor
+refresh_executor = futures.ThreadPoolExecutor(
+    max_workers=4, thread_name_prefix="weblib-refresh"
+)
+# Upstream results, before any per-user state is applied. Keyed by
+# (source, normalised query, num_results, filters the source reads)
+results_cache: cache.TTLCache[
+    tuple[str, str, int, tuple[tuple[str, str], ...]],
+    tuple[dict[str, str | bool | int], ...],
+] = cache.TTLCache(
+    max_size=512, ttl=600.0, stale_ttl=3600.0, executor=refresh_executor
+)
+# Seconds to wait on a call sent to executor, including time spent queued
+CALL_TIMEOUT = 10.0
+# Set by stream() while a source loads, so store_page() can hand over the
+# items already stored before it waits on the upsert of the new ones
+stored_items_listener: contextvars.ContextVar[
+    Optional[Callable[[list[dict[str, str | bool | int]]], None]]
+] = contextvars.ContextVar("stored_items_listener", default=None)
 
-def gbooks(
+
+def get_json(url: str, timeout: float) -> Any:
+    res = client.client.get(url, timeout=timeout)
+    # Raised as requests.HTTPError, so the source's breaker sees a 5xx
+    res.raise_for_status()
+    return res.json()
+
+
+def thumb_mime(url: str) -> tuple[str, bool]:
+    """Returns the guessed MIME type for a thumbnail URL, and whether it
+    still needs to be probed once the item exists"""
+    guessed: Optional[str] = mime.guess(url)
+    if guessed is None:
+        return "", True
+    return guessed, False
+
+
+def store_page(
+    order: list[str],
+    stored: dict[str, dict[str, str | bool | int]],
+    new_items: list[dict[str, str | int]],
+    probes: dict[str, str],
+) -> list[dict[str, str | bool | int]]:
+    """Writes a page's new items in one upsert, queues the thumbnails that
+    still need probing, and returns the whole page in upstream order
+    order(list[str]): source ids in upstream order
+    stored(dict): items already in the DB, keyed by source id
+    new_items(list[dict]): Item columns for results not stored yet
+    probes(dict[str, str]): thumbnail URLs to probe, keyed by source id"""
+    listener = stored_items_listener.get()
+    if listener is not None and len(new_items) != 0 and len(stored) != 0:
+        listener([stored[source_id] for source_id in order if source_id in stored])
+    for item in db.upsert_items(new_items):
+        source_id = str(item["source_id"])
+        stored[source_id] = item
+        if source_id in probes and item["thumb_mime"] == "":
+            mime.resolver.submit(int(item["id"]), probes[source_id])
+    return [stored[source_id] for source_id in order]
+
+
+def cache_key(
+    source: str, query: str, num_results: int, filters: dict[str, str]
+) -> tuple[str, str, int, tuple[tuple[str, str], ...]]:
+    return (
+        source,
+        " ".join(query.split()).casefold(),
+        num_results,
+        tuple(sorted(filters.items())),
+    )
+
+
+def apply_user_state(
+    items: tuple[dict[str, str | bool | int], ...], user_id: Optional[int]
+) -> list[dict[str, str | bool | int]]:
+    """Copies shared search results, marking which ones user_id has saved and
+    recording them in their recently searched list"""
+    if user_id is None:
+        return [dict(item) for item in items]
+    item_ids = [int(item["id"]) for item in items]
+    saved_ids: set[int] = db.get_saved_item_ids(user_id, item_ids)
+    db.record_recently_searched(user_id, item_ids)
+    return [
+        {**item, "saved": item_id in saved_ids}
+        for item, item_id in zip(items, item_ids)
+    ]
+
+
+def search(
+    source_key: str,
     query: str,
     num_results: int,
     filters: dict[str, str],
     *,
     user_id: Optional[int] = None,
+) -> list[dict[str, str | bool | int]]:
+    """Function to search one registered source, serving repeat queries from
+    cache
+    source_key(str): the source filter value, e.g. "gbooks"
+    query(str): the search query
+    num_results(int): how many results to return
+    filters(dict[str, str]): the search filters
+    kwargs:
+    user_id(int | None): the user_id, to check if returned items are saved or not
+    Raises sources.SourceUnavailable if the source is failing or overloaded"""
+    return apply_user_state(
+        load(sources.get(source_key), query, num_results, filters), user_id
+    )
+
+
+def load(
+    source: sources.Source, query: str, num_results: int, filters: dict[str, str]
+) -> tuple[dict[str, str | bool | int], ...]:
+    page = results_cache.get_or_load(
+        cache_key(
+            source.name, query, num_results, source.relevant_filters(filters)
+        ),
+        lambda: tuple(source.call(query, num_results, filters)),
+    )
+    return fill_thumb_mimes(source.name, page)
+
+
+def fill_thumb_mimes(
+    source_name: str, page: tuple[dict[str, str | bool | int], ...]
+) -> tuple[dict[str, str | bool | int], ...]:
+    """Re-reads the items of a cached page that had no thumbnail MIME type,
+    as the resolver may have found it since, and queues any still without
+    one to be probed again. Items the resolver has given up on are left"""
+    blank = [
+        str(item["source_id"])
+        for item in page
+        if item["thumb_mime"] == ""
+        and item["thumb_url"] != ""
+        and mime.resolver.should_probe(int(item["id"]))
+    ]
+    if len(blank) == 0:
+        return page
+    stored = db.get_items_by_source(source_name, blank)
+    for item in stored.values():
+        if item["thumb_mime"] == "":
+            mime.resolver.submit(int(item["id"]), str(item["thumb_url"]))
+    return tuple(
+        (
+            {**item, "thumb_mime": stored[str(item["source_id"])]["thumb_mime"]}
+            if str(item["source_id"]) in stored
+            else item
+        )
+        for item in page
+    )
+
+
+def fetch_gbooks(
+    query: str, num_results: int, filters: dict[str, str]
 ) -> list[dict[str, str | bool | int]]:
     quoted_query: str = parse.quote_plus(query, safe=":")
-    results: list[dict[str, str | bool | int]] = []
+    order: list[str] = []
+    new_items: list[dict[str, str | int]] = []
+    probes: dict[str, str] = {}
     api_url = "https://www.googleapis.com/books/v1/volumes?"
     url: str = (
         f"{api_url}q={quoted_query}&maxResults={num_results}"
@@ -23,7 +184,6 @@ def gbooks(
         + f"&filter={filters['available']}&printType={filters['print']}"
     )
     print(url)
-    headers = {"User-Agent": "WebLib/1.0 (https://github.com/lvoz2/weblib) (gzip)"}
     res: dict[
         str,
         str
@@ -44,7 +204,7 @@ def gbooks(
                 ],
             ]
         ],
-    ] = (requests.get(url, headers=headers, timeout=10.0)).json()
+    ] = get_json(url, 10.0)
     volumes: list[
         dict[
             str,
@@ -65,7 +225,10 @@ def gbooks(
         if "items" in res
         else []
     )
-    volumes.reverse()
+    stored: dict[str, dict[str, str | bool | int]] = db.get_items_by_source(
+        "Google Books",
+        [volume["id"] for volume in volumes if isinstance(volume.get("id"), str)],
+    )
     for volume in volumes:
         vol_id: Optional[str] = (
             (volume["id"] if isinstance(volume["id"], str) else None)
@@ -88,11 +251,9 @@ def gbooks(
             if "volumeInfo" in volume
             else None
         )
-        if vol_id is not None and vol_info is not None:
-            item: Optional[dict[str, str | bool | int]] = db.get_item_by_source(
-                "Google Books", vol_id, user_id, add_to_recent_search=True
-            )
-            if item is None:
+        if vol_id is not None and vol_info is not None and vol_id not in order:
+            order.append(vol_id)
+            if vol_id not in stored:
                 # Haven't stored item metadata yet
                 description: str = (
                     (
@@ -112,6 +273,7 @@ def gbooks(
                     f". {vol_info['description']}" if "description" in vol_info else ""
                 )
                 thumb: dict[str, str] = {"url": "", "mime": ""}
+                needs_probe = False
                 # Apparently this walrus will still exist outside the scope of the if
                 if has_thumb := (
                     (
@@ -131,9 +293,7 @@ def gbooks(
                     thumb["url"] = (
                         potential_url if isinstance(potential_url, str) else ""
                     )
-                    thumb["mime"] = (
-                        requests.head(thumb["url"], headers=headers, timeout=5.0)
-                    ).headers["content-type"]
+                    thumb["mime"], needs_probe = thumb_mime(thumb["url"])
                 title: str = (
                     vol_info["title"]
                     if "title" in vol_info and isinstance(vol_info["title"], str)
@@ -154,86 +314,65 @@ def gbooks(
                     "source_name": "Google Books",
                     "source_id": vol_id,
                 }
-                results.append(
-                    db.create_item(volume_data, user_id, add_to_recent_search=True)
-                )
-            else:
-                # Have got item metadata
-                results.append(item)
-    results.reverse()
-    return results
+                new_items.append(volume_data)
+                if needs_probe:
+                    probes[vol_id] = thumb["url"]
+    return store_page(order, stored, new_items, probes)
 
 
-def wikipedia(
-    query: str,
-    num_results: int,
-    *,
-    user_id: Optional[int] = None,
+def fetch_wikipedia(
+    query: str, num_results: int, filters: dict[str, str]
 ) -> list[dict[str, str | bool | int]]:
-    """Function to search Wikipedia
-    query(str): the search query
-    num_results(int): how many results to return
-    kwargs:
-    user_id(int | None): the user_id, to check if returned items are saved or not"""
     quoted_query: str = parse.quote(query)
-    results: list[dict[str, str | bool | int]] = []
+    new_items: list[dict[str, str | int]] = []
+    probes: dict[str, str] = {}
     api_url = "https://en.wikipedia.org/w/api.php?"
     url = (
         f"{api_url}action=query&format=json&list=search&formatversion=2&"
         + f"srsearch={quoted_query}&srlimit={num_results}"
     )
-    headers = {"User-Agent": "WebLib/1.0 (https://github.com/lvoz2/weblib)"}
-    response = requests.get(url, headers=headers, timeout=10.0)
-    pages = response.json()["query"]["search"]
-    page_ids = []
-    items = {}
-    correct_order = [str(page["pageid"]) for page in pages]
-    # Reversals for correct recently searched ordering
-    pages.reverse()
-    for page in pages:
-        page_id: str = str(page["pageid"])
-        item: Optional[dict[str, str | bool | int]] = db.get_item_by_source(
-            "Wikipedia", page_id, user_id
-        )
-        if item is None:
-            page_ids.append(page_id)
-        else:
-            items[page_id] = item
+    pages = get_json(url, 10.0)["query"]["search"]
+    items: dict[str, dict[str, str | bool | int]] = db.get_items_by_source(
+        "Wikipedia", [str(page["pageid"]) for page in pages]
+    )
+    page_ids = [
+        str(page["pageid"]) for page in pages if str(page["pageid"]) not in items
+    ]
     if len(page_ids) != 0:
         page_ids_url = "|".join(page_ids)
-        info_res = requests.get(
+        # The three metadata calls are independent, so send them together
+        info_future = executor.submit(
+            get_json,
             f"{api_url}action=query&prop=info&inprop=url&format=json&"
             + f"pageids={page_ids_url}",
-            headers=headers,
-            timeout=5.0,
+            5.0,
         )
-        thumb_res = requests.get(
+        thumb_future = executor.submit(
+            get_json,
             f"{api_url}action=query&prop=pageimages&piprop=name|thumbnail&"
             + f"pithumbsize=200&format=json&pageids={page_ids_url}",
-            headers=headers,
-            timeout=5.0,
+            5.0,
         )
-        extract_res = requests.get(
-            "https://en.wikipedia.org/w/api.php?action=query&prop=extracts&"
+        extract_future = executor.submit(
+            get_json,
+            f"{api_url}action=query&prop=extracts&"
             + f"explaintext&exintro&format=json&pageids={page_ids_url}",
-            headers=headers,
-            timeout=5.0,
+            5.0,
         )
-        info_json = info_res.json()["query"]["pages"]
-        thumb_json = thumb_res.json()["query"]["pages"]
-        extract_json = extract_res.json()["query"]["pages"]
+        thumb_json = thumb_future.result(CALL_TIMEOUT)["query"]["pages"]
+        info_json = info_future.result(CALL_TIMEOUT)["query"]["pages"]
+        extract_json = extract_future.result(CALL_TIMEOUT)["query"]["pages"]
     for page in pages:
         page_id = str(page["pageid"])
         if page_id in page_ids:
             has_thumb = "thumbnail" in thumb_json[page_id].keys()
             # Smaller than the minimum
             thumb_height = -1
-            thumb_mime = ""
+            page_thumb_mime = ""
+            needs_probe = False
             if has_thumb:
                 thumb_url = thumb_json[page_id]["thumbnail"]["source"]
-                thumb_mime = (
-                    requests.head(thumb_url, headers=headers, timeout=5.0)
-                ).headers["content-type"]
+                page_thumb_mime, needs_probe = thumb_mime(thumb_url)
                 thumb_height = thumb_json[page_id]["thumbnail"]["height"]
             # Clamps to 0-135px max img height. If no img, should be 0
             thumb_height = max(0, min(135, thumb_height))
@@ -241,24 +380,207 @@ def wikipedia(
                 "title": page["title"],
                 "description": extract_json[page_id]["extract"],
                 "thumb_url": thumb_url if has_thumb else "",
-                "thumb_mime": (thumb_mime if has_thumb else ""),
+                "thumb_mime": (page_thumb_mime if has_thumb else ""),
                 "thumb_height": thumb_height,
                 "source_url": info_json[page_id]["fullurl"],
                 "source_name": "Wikipedia",
                 "source_id": page_id,
             }
-            results.append(
-                db.create_item(wiki_result, user_id, add_to_recent_search=True)
-            )
-        else:
-            results.append(items[page_id])
-            # So cached results arent behind new results in recent search list
-            db.get_item_by_source(
-                "Wikipedia", page_id, user_id, add_to_recent_search=True
+            new_items.append(wiki_result)
+            if needs_probe:
+                probes[page_id] = thumb_url
+    return store_page(
+        [str(page["pageid"]) for page in pages], items, new_items, probes
+    )
+
+
+def fetch_openlib(
+    query: str, num_results: int, filters: dict[str, str]
+) -> list[dict[str, str | bool | int]]:
+    quoted_query: str = parse.quote_plus(query)
+    url = (
+        f"https://openlibrary.org/search.json?q={quoted_query}&limit={num_results}"
+        + "&fields=key,title,author_name,cover_i,first_publish_year"
+    )
+    docs: list[dict[str, Any]] = get_json(url, 10.0).get("docs", [])
+    # Keys look like "/works/OL45883W", only the last part is kept
+    works: dict[str, dict[str, Any]] = {
+        doc["key"].rsplit("/", 1)[-1]: doc
+        for doc in docs
+        if isinstance(doc.get("key"), str)
+    }
+    stored: dict[str, dict[str, str | bool | int]] = db.get_items_by_source(
+        "Open Library", list(works)
+    )
+    new_items: list[dict[str, str | int]] = []
+    probes: dict[str, str] = {}
+    for work_id, doc in works.items():
+        if work_id in stored:
+            continue
+        authors: list[str] = [
+            author for author in doc.get("author_name", []) if isinstance(author, str)
+        ]
+        description: str = ("By " + ", ".join(authors) + ". " if authors else "") + (
+            f"First published in {doc['first_publish_year']}."
+            if "first_publish_year" in doc
+            else ""
+        )
+        thumb_url: str = (
+            f"https://covers.openlibrary.org/b/id/{doc['cover_i']}-M.jpg"
+            if "cover_i" in doc
+            else ""
+        )
+        cover_mime, needs_probe = thumb_mime(thumb_url)
+        new_items.append(
+            {
+                "title": doc.get("title", ""),
+                "description": description.strip(),
+                "thumb_url": thumb_url,
+                "thumb_mime": cover_mime,
+                "thumb_height": 135 if thumb_url != "" else 0,
+                "source_url": f"https://openlibrary.org{doc['key']}",
+                "source_name": "Open Library",
+                "source_id": work_id,
+            }
+        )
+        if needs_probe:
+            probes[work_id] = thumb_url
+    return store_page(list(works), stored, new_items, probes)
+
+
+def all_sources(
+    query: str,
+    num_results: int,
+    filters: dict[str, str],
+    *,
+    user_id: Optional[int] = None,
+) -> list[dict[str, str | bool | int]]:
+    """Function to search every registered source at once, interleaving
+    their results
+    query(str): the search query
+    num_results(int): how many results to return in total
+    filters(dict[str, str]): the filters, passed to sources that use them
+    kwargs:
+    user_id(int | None): the user_id, to check if returned items are saved or not
+    A source that errors, is unavailable or misses its timeout is left out.
+    A search that timed out keeps running, so the next identical query can
+    be served from cache. Raises ValueError if filters lacks one a source
+    reads"""
+    for source in sources.registry.values():
+        source.check_filters(filters)
+    start = time.monotonic()
+    pending: dict[
+        sources.Source, futures.Future[tuple[dict[str, str | bool | int], ...]]
+    ] = {
+        source: source_executor.submit(load, source, query, num_results, filters)
+        for source in sources.registry.values()
+    }
+    pages: list[tuple[dict[str, str | bool | int], ...]] = []
+    for source, future in pending.items():
+        remaining = max(0.0, start + source.timeout - time.monotonic())
+        try:
+            pages.append(future.result(timeout=remaining))
+        except futures.TimeoutError:
+            print(f"{source.name} timed out after {source.timeout}s")
+        except Exception as e:
+            print(e)
+    return apply_user_state(tuple(interleave(pages)[:num_results]), user_id)
+
+
+def stream(
+    source_key: str,
+    query: str,
+    num_results: int,
+    filters: dict[str, str],
+    *,
+    user_id: Optional[int] = None,
+) -> Iterator[dict[str, str | bool | int]]:
+    """Generator version of search() and all_sources(). Results a source
+    already has stored are yielded as soon as its upstream answers, and the
+    rest once they have been written
+    source_key(str): the source filter value, or "all" for every source
+    query(str): the search query
+    num_results(int): how many results to yield in total
+    filters(dict[str, str]): the search filters
+    kwargs:
+    user_id(int | None): the user_id, to check if returned items are saved or not
+    Errors from a single source are raised. With "all", failing sources are
+    skipped and the stream ends once the slowest source's timeout is up"""
+    federated = source_key == "all"
+    chosen: list[sources.Source] = (
+        list(sources.registry.values()) if federated else [sources.get(source_key)]
+    )
+    # (whether the source has finished, its items or its error)
+    events: queue.Queue[
+        tuple[bool, tuple[dict[str, str | bool | int], ...] | Exception]
+    ] = queue.Queue()
+
+    def run(source: sources.Source) -> None:
+        token = stored_items_listener.set(
+            lambda items: events.put((False, tuple(items)))
+        )
+        try:
+            events.put((True, load(source, query, num_results, filters)))
+        except Exception as e:
+            events.put((True, e))
+        finally:
+            stored_items_listener.reset(token)
+
+    for source in chosen:
+        source_executor.submit(run, source)
+    timeout: Optional[float] = (
+        max(source.timeout for source in chosen) if federated else None
+    )
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    running = len(chosen)
+    sent_ids: set[int] = set()
+    while running > 0 and len(sent_ids) < num_results:
+        try:
+            done, result = events.get(
+                timeout=(
+                    max(0.0, deadline - time.monotonic())
+                    if deadline is not None
+                    else None
+                )
             )
-    return sorted(
-        results,
-        key=lambda item: correct_order.index(
-            item["source_id"] if isinstance(item["source_id"], str) else ""
-        ),
+        except queue.Empty:
+            print(f"Stopped waiting on sources after {timeout}s")
+            return
+        if done:
+            running -= 1
+        if isinstance(result, Exception):
+            if not federated:
+                raise result
+            print(result)
+            continue
+        # The whole page is recorded again once it is done, in ranked order
+        for item in apply_user_state(result[:num_results], user_id):
+            if int(item["id"]) in sent_ids:
+                continue
+            if len(sent_ids) >= num_results:
+                return
+            sent_ids.add(int(item["id"]))
+            yield item
+
+
+def interleave(
+    pages: list[tuple[dict[str, str | bool | int], ...]],
+) -> list[dict[str, str | bool | int]]:
+    """Merges ranked result pages round-robin, so each source's top result
+    comes before any source's second"""
+    merged: list[dict[str, str | bool | int]] = []
+    for rank in range(max((len(page) for page in pages), default=0)):
+        merged.extend(page[rank] for page in pages if rank < len(page))
+    return merged
+
+
+sources.register(sources.Source("wikipedia", "Wikipedia", fetch_wikipedia))
+sources.register(
+    sources.Source(
+        "gbooks",
+        "Google Books",
+        fetch_gbooks,
+        filters=("download", "available", "print"),
     )
+)
+sources.register(sources.Source("openLib", "Open Library", fetch_openlib))
@@ -0,0 +1,85 @@
+"""Where each visitor's flask.session is kept, chosen with SESSION_BACKEND"""
+
+import os
+
+import cachelib
+import flask
+import flask_session
+import flask_sqlalchemy
+import sqlalchemy
+
+from src import db
+
+# "cookie" keeps the whole session in a signed cookie, so needs SECRET_KEY.
+# "memory" is per process and "filesystem" is shared by processes on one
+# host. "sqlalchemy" keeps them apart from the catalogue, so session writes
+# never wait on its write lock
+BACKENDS = ("cookie", "memory", "filesystem", "sqlalchemy")
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "sqlalchemy")
+# A SQLite file of their own, as SQLite locks the whole file to write. Servers
+# lock rows, so there sessions default to a schema in the catalogue database
+SESSION_DATABASE_URL = os.environ.get("SESSION_DATABASE_URL") or (
+    "sqlite:///sessions.db"
+    if db.DATABASE_URL.startswith("sqlite")
+    else db.DATABASE_URL
+)
+# The schema holding the sessions table when it shares DATABASE_URL
+SESSION_SCHEMA = os.environ.get("SESSION_SCHEMA", "weblib_sessions")
+# Stored sessions kept before expired ones are swept, all in one pass
+CACHE_THRESHOLD = 5000
+# The sqlalchemy store deletes expired sessions on about 1 in this many requests
+CLEANUP_N_REQUESTS = 100
+
+
+def init_app(app: flask.Flask, backend: str = SESSION_BACKEND) -> None:
+    """Sets up app's session interface for backend, one of BACKENDS"""
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown session backend "{backend}"')
+    secret_key = os.environ.get("SECRET_KEY")
+    if secret_key:
+        app.secret_key = secret_key
+    if backend == "cookie":
+        if not secret_key:
+            raise RuntimeError("Set SECRET_KEY to keep sessions in cookies")
+        # Flask's own signed cookie sessions
+        return
+    if backend == "sqlalchemy":
+        app.config["SESSION_TYPE"] = "sqlalchemy"
+        app.config["SQLALCHEMY_DATABASE_URI"] = SESSION_DATABASE_URL
+        client = flask_sqlalchemy.SQLAlchemy(app)
+        with app.app_context():
+            db.apply_profile(client.engine)
+            # SQLite has no schemas, and shares nothing between files anyway
+            if (
+                SESSION_DATABASE_URL == db.DATABASE_URL
+                and client.engine.dialect.name != "sqlite"
+            ):
+                with client.engine.begin() as connection:
+                    connection.execute(
+                        sqlalchemy.schema.CreateSchema(
+                            SESSION_SCHEMA, if_not_exists=True
+                        )
+                    )
+                app.config["SESSION_SQLALCHEMY_SCHEMA"] = SESSION_SCHEMA
+        app.config["SESSION_SQLALCHEMY"] = client
+        app.config["SESSION_CLEANUP_N_REQUESTS"] = CLEANUP_N_REQUESTS
+    else:
+        app.config["SESSION_TYPE"] = "cachelib"
+        # Entries expire with the session lifetime Flask-Session passes in
+        app.config["SESSION_CACHELIB"] = (
+            cachelib.SimpleCache(threshold=CACHE_THRESHOLD)
+            if backend == "memory"
+            else cachelib.FileSystemCache("flask_session", threshold=CACHE_THRESHOLD)
+        )
+    flask_session.Session(app)
+
+
+def regenerate() -> None:
+    """Starts a fresh session at login, so a session id known before login
+    can't be used to ride on it"""
+    regenerate_id = getattr(flask.current_app.session_interface, "regenerate", None)
+    if regenerate_id is not None:
+        regenerate_id(flask.session)
+    else:
+        # A signed cookie is the whole session, so emptying it is enough
+        flask.session.clear()
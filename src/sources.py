@@ -0,0 +1,157 @@
+"""Registry of the upstream sites items can be searched from"""
+
+import threading
+import time
+from typing import Callable, Optional
+
+import requests
+
+Fetch = Callable[[str, int, dict[str, str]], list[dict[str, str | bool | int]]]
+
+
+class SourceUnavailable(Exception):
+    """Raised instead of calling a source that is failing or overloaded"""
+
+
+def is_upstream_failure(error: Exception) -> bool:
+    """Whether error says the upstream is failing, rather than that the
+    search itself was bad. Only these count towards opening a breaker"""
+    if isinstance(error, requests.HTTPError):
+        return error.response is None or error.response.status_code in (
+            429,
+            *range(500, 600),
+        )
+    return isinstance(error, (requests.RequestException, TimeoutError))
+
+
+class CircuitBreaker:
+    """Stops calls to an upstream once failure_threshold calls in a row have
+    failed. After reset_timeout seconds a single trial call is let through,
+    and its outcome closes the breaker again or keeps it open"""
+
+    def __init__(
+        self, failure_threshold: int = 5, reset_timeout: float = 30.0
+    ) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if (
+                time.monotonic() - self._opened_at >= self.reset_timeout
+                and not self._trial_running
+            ):
+                self._trial_running = True
+                return True
+            return False
+
+    def cancel_trial(self) -> None:
+        with self._lock:
+            self._trial_running = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+class Source:
+    """An upstream site, wrapped with a concurrency limit and a breaker
+    key(str): the id used by the source filter
+    name(str): the source_name stored on its items
+    fetch(Fetch): searches the site, returning stored items in ranked order
+    filters(tuple[str, ...]): the filter names fetch reads
+    max_concurrent(int): searches allowed in flight at once
+    timeout(float): seconds to wait for a search slot, and how long an
+    all-sources search waits on this source"""
+
+    def __init__(
+        self,
+        key: str,
+        name: str,
+        fetch: Fetch,
+        *,
+        filters: tuple[str, ...] = (),
+        max_concurrent: int = 4,
+        timeout: float = 6.0,
+        breaker: Optional[CircuitBreaker] = None,
+    ) -> None:
+        self.key = key
+        self.name = name
+        self.fetch = fetch
+        self.filters = filters
+        self.timeout = timeout
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+
+    def relevant_filters(self, filters: dict[str, str]) -> dict[str, str]:
+        return {name: filters[name] for name in self.filters if name in filters}
+
+    def check_filters(self, filters: dict[str, str]) -> None:
+        """Raises ValueError if filters is missing one that fetch reads"""
+        missing = [
+            name for name in self.filters if not isinstance(filters.get(name), str)
+        ]
+        if len(missing) != 0:
+            raise ValueError(f"{self.name} needs the {', '.join(missing)} filters")
+
+    def call(
+        self, query: str, num_results: int, filters: dict[str, str]
+    ) -> list[dict[str, str | bool | int]]:
+        self.check_filters(filters)
+        if not self.breaker.allow():
+            raise SourceUnavailable(f"{self.name} is temporarily unavailable")
+        if not self._slots.acquire(timeout=self.timeout):
+            # No call was made, so it says nothing about the upstream
+            self.breaker.cancel_trial()
+            raise SourceUnavailable(f"{self.name} is too busy right now")
+        try:
+            results = self.fetch(query, num_results, self.relevant_filters(filters))
+        except Exception as e:
+            if is_upstream_failure(e):
+                self.breaker.record_failure()
+            else:
+                # A bug or a bad search says nothing about the upstream
+                self.breaker.cancel_trial()
+            raise
+        finally:
+            self._slots.release()
+        self.breaker.record_success()
+        return results
+
+
+registry: dict[str, Source] = {}
+
+
+def register(source: Source) -> Source:
+    registry[source.key] = source
+    return source
+
+
+def get(key: str) -> Source:
+    if key not in registry:
+        raise ValueError("Source filter not in list of allowed values")
+    return registry[key]
@@ -17,17 +17,24 @@ export function wrapCard(e) {
     }
 }
 
-export function wrapCards () {
-    document.querySelectorAll(".card-description").forEach((e) => {
-        wrapCard(e)
-        // From MDN: https://developer.mozilla.org/en-US/docs/Web/API/ResizeObserver
-        const resizeObserver = new ResizeObserver((entries) => {
-            for (const entry of entries) {
-                wrapCard(entry.target)
-            }
-        });
-        resizeObserver.observe(e);
+function observeDescription(e) {
+    wrapCard(e)
+    // From MDN: https://developer.mozilla.org/en-US/docs/Web/API/ResizeObserver
+    const resizeObserver = new ResizeObserver((entries) => {
+        for (const entry of entries) {
+            wrapCard(entry.target)
+        }
     });
+    resizeObserver.observe(e);
+}
+
+export function wrapCards () {
+    document.querySelectorAll(".card-description").forEach(observeDescription);
+}
+
+// For cards added one at a time, once they are in the document
+export function wrapNewCard(card) {
+    card.querySelectorAll(".card-description").forEach(observeDescription);
 }
 
 export async function toggleSave(e) {
@@ -168,4 +175,4 @@ export function init() {
     });
 }
 
-export default { wrapCard, wrapCards, toggleSave, createCard, init };
+export default { wrapCard, wrapCards, wrapNewCard, toggleSave, createCard, init };
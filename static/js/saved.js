@@ -0,0 +1,62 @@
+"use strict";
+
+import { wrapNewCard, createCard } from "./card.js";
+
+let loading = false;
+
+async function loadMore(sentinel, observer) {
+    if (loading) {
+        return;
+    }
+    loading = true;
+    let json;
+    try {
+        json = await fetch("/api/saved?cursor=" + encodeURIComponent(sentinel.dataset.cursor))
+            .then(res => res.json());
+    } catch (e) {
+        // Scrolling the sentinel back into view tries again
+        console.error(e);
+        return;
+    } finally {
+        loading = false;
+    }
+    if (!json.status) {
+        observer.disconnect();
+        alert("An issue happened while loading saved items. Please notify site owner, sending them this error message: " + json.error);
+        return;
+    }
+    for (const item of json.items) {
+        const card = createCard(item);
+        // Keep the sentinel last, so it is only seen again at the new end
+        sentinel.before(card);
+        wrapNewCard(card);
+    }
+    if (json.next_cursor == null) {
+        observer.disconnect();
+        sentinel.remove();
+    } else {
+        sentinel.dataset.cursor = json.next_cursor;
+        // Re-observing reports the sentinel again if it is still in view
+        observer.unobserve(sentinel);
+        observer.observe(sentinel);
+    }
+}
+
+function init() {
+    const sentinel = document.getElementById("savedMore");
+    if (sentinel == null) {
+        return;
+    }
+    const observer = new IntersectionObserver((entries) => {
+        if (entries.some((entry) => entry.isIntersecting)) {
+            loadMore(sentinel, observer);
+        }
+    }, { rootMargin: "400px" });
+    observer.observe(sentinel);
+}
+
+if (document.readyState !== "loading") {
+    init()
+} else {
+    document.addEventListener("DOMContentLoaded", init);
+}
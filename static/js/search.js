@@ -1,6 +1,6 @@
 "use strict";
 
-import { wrapCards, createCard } from "./card.js";
+import { wrapNewCard, createCard } from "./card.js";
 
 function showFilters() {
     const el = document.querySelectorAll(".filter-options[name=source]")[0];
@@ -34,12 +34,12 @@ async function search(e) {
                 break;
         }
     }
-    if (filterData.source === "wiktionary" || filterData.source === "openLib") {
+    if (filterData.source === "wiktionary") {
         alert("This search source is not implemented yet! Please use something else.")
         return
     }
     const num_results = parseInt(document.getElementById("resultsSliderLabel").innerText);
-    const json = await fetch("/api/browse/search", {
+    const res = await fetch("/api/browse/search/stream", {
         method: "POST",
         headers: {
             "Content-Type": "application/json"
@@ -49,27 +49,42 @@ async function search(e) {
             num_results: num_results,
             filters: filterData
         })
-    }).then(res => res.json()).then(json => {
-        return json;
     });
-    if (!json.status) {
-        alert("An issue happened during search. Please notify site owner, sending them this error message: " + json.error);
-        return;
-    }
-    if (!Object.hasOwnProperty.call(json, "results")) {
-        throw new Error("Results not in API response");
+    const resultsE = document.getElementById("resultsInner");
+    // Each line of the response is one JSON object, sent as soon as it's ready
+    const reader = res.body.pipeThrough(new TextDecoderStream()).getReader();
+    let buffer = "";
+    let count = 0;
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) {
+            break;
+        }
+        buffer += value;
+        const lines = buffer.split("\n");
+        buffer = lines.pop();
+        for (const line of lines) {
+            if (line.trim() === "") {
+                continue;
+            }
+            const json = JSON.parse(line);
+            if (!json.status) {
+                alert("An issue happened during search. Please notify site owner, sending them this error message: " + json.error);
+                return;
+            }
+            if (count === 0) {
+                resultsE.innerHTML = "";
+            }
+            const card = createCard(json.item);
+            resultsE.append(card);
+            wrapNewCard(card);
+            count++;
+        }
     }
-    if (json.results.length == 0) {
+    if (count == 0) {
         alert("Either no items were found for your search query, or an error occured because of the query. Please change your query and try again")
         return;
     }
-    const resultsE = document.getElementById("resultsInner");
-    resultsE.innerHTML = "";
-    for (const item of json.results) {
-        const card = createCard(item);
-        resultsE.append(card);
-    }
-    wrapCards()
 }
 
 function resultsSlider(e) {
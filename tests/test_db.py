@@ -0,0 +1,179 @@
+"""Tests for the db read and write paths. They run against DATABASE_URL when
+it is set, such as a scratch PostgreSQL database, and a temporary SQLite
+file otherwise. Every table is dropped after each test"""
+
+import os
+import pathlib
+from typing import Any, Iterator
+
+import pytest
+import sqlalchemy
+from sqlalchemy import orm
+
+from src import db
+
+
+@pytest.fixture(autouse=True)
+def database(tmp_path: pathlib.Path) -> Iterator[None]:
+    url = os.environ.get("DATABASE_URL", f"sqlite:///{tmp_path / 'test.db'}")
+    db.configure(url, read_url=url)
+    db.setup_db()
+    yield
+    db.item_cache.clear()
+    db.item_ids_by_source.clear()
+    db.Base.metadata.drop_all(db.engine)
+    db.dispose_engines()
+
+
+def make_user(sub: str = "1") -> int:
+    user = db.get_or_create_user(
+        f"{sub}@example.com", "google", {"sub": sub}, name="Name", username=sub
+    )
+    return int(user["id"])
+
+
+def item_data(source_id: str, title: str = "Title") -> dict[str, str | int]:
+    return {
+        "title": title,
+        "description": "",
+        "thumb_url": "",
+        "thumb_mime": "",
+        "thumb_height": 0,
+        "source_url": f"https://example.com/{source_id}",
+        "source_name": "Test",
+        "source_id": source_id,
+    }
+
+
+def make_items(count: int) -> list[int]:
+    items = db.upsert_items([item_data(str(i)) for i in range(count)])
+    return [int(item["id"]) for item in items]
+
+
+def test_upsert_items_keeps_order_and_existing_rows() -> None:
+    first = db.upsert_items([item_data("a", "Old"), item_data("b")])
+    db.item_cache.clear()
+    db.item_ids_by_source.clear()
+    second = db.upsert_items(
+        [item_data("c"), item_data("a", "New"), item_data("c"), item_data("b")]
+    )
+    assert [item["source_id"] for item in second] == ["c", "a", "c", "b"]
+    assert second[1]["id"] == first[0]["id"]
+    assert second[1]["title"] == "Old"
+    assert second[0]["id"] == second[2]["id"]
+    assert db.get_items_by_source("Test", ["a", "b", "c"]).keys() == {"a", "b", "c"}
+
+
+def test_recently_searched_is_trimmed_top_result_first(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(db.User, "recent_max_len", 3)
+    user_id = make_user()
+    item_ids = make_items(5)
+    assert db.record_recently_searched(user_id, item_ids) is None
+    searched = db.get_home_feed(user_id)["recently_searched"]
+    assert searched is not None
+    assert [int(item["id"]) for item in searched] == item_ids[:3]
+    assert db.record_recently_searched(user_id + 1, item_ids) == "user_id not valid"
+
+
+def test_recently_viewed_drops_unknown_and_trims(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(db.User, "recent_max_len", 2)
+    user_id = make_user()
+    item_ids = make_items(3)
+    db.record_recently_viewed(
+        {
+            (user_id, item_ids[0]): 1,
+            (user_id, item_ids[1]): 2,
+            (user_id, item_ids[2]): 3,
+            (user_id + 1, item_ids[0]): 4,
+            (user_id, item_ids[2] + 1): 5,
+        }
+    )
+    viewed = db.get_home_feed(user_id)["recently_viewed"]
+    assert viewed is not None
+    assert [int(item["id"]) for item in viewed] == [item_ids[2], item_ids[1]]
+
+
+def test_home_feed_marks_saved_items() -> None:
+    user_id = make_user()
+    item_ids = make_items(3)
+    assert db.get_home_feed(user_id) == {
+        "saved": None,
+        "recently_viewed": None,
+        "recently_searched": None,
+    }
+    db.record_recently_searched(user_id, item_ids)
+    db.save_item(item_ids[1], user_id)
+    feed = db.get_home_feed(user_id)
+    assert feed["recently_viewed"] is None
+    assert [(int(item["id"]), item["saved"]) for item in feed["saved"] or []] == [
+        (item_ids[1], True)
+    ]
+    assert [item["saved"] for item in feed["recently_searched"] or []] == [
+        False,
+        True,
+        False,
+    ]
+
+
+def test_saved_items_pages_follow_the_cursor() -> None:
+    user_id = make_user()
+    item_ids = make_items(5)
+    for item_id in item_ids:
+        db.save_item(item_id, user_id)
+    pages: list[list[int]] = []
+    cursor = None
+    while True:
+        items, cursor = db.get_saved_items_page(user_id, cursor, limit=2)
+        pages.append([int(item["id"]) for item in items])
+        assert all(item["saved"] for item in items)
+        if cursor is None:
+            break
+    assert pages == [item_ids[:2:-1], item_ids[2:0:-1], item_ids[:1]]
+    with pytest.raises(ValueError):
+        db.get_saved_items_page(user_id, "not a cursor")
+
+
+def test_get_or_create_user_returns_existing_user() -> None:
+    assert make_user() == make_user()
+    assert make_user("2") != make_user()
+
+
+def test_get_or_create_user_loses_race_to_concurrent_login(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    scalars = orm.Session.scalars
+    other_logins: list[int] = []
+
+    def lookup_before_other_login(
+        self: orm.Session, statement: sqlalchemy.Select[Any], *args: Any, **kwargs: Any
+    ) -> Any:
+        if len(other_logins) == 0:
+            # The other login commits between this lookup and the insert
+            with orm.Session(db.engine) as other, other.begin():
+                user = db.User(
+                    email="1@example.com",
+                    login_platform="google",
+                    platform_id={"sub": "1"},
+                    platform_key=db.platform_key({"sub": "1"}),
+                    name="Name",
+                    username="1",
+                )
+                other.add(user)
+                other.flush()
+                other_logins.append(user.id)
+            statement = statement.where(sqlalchemy.false())
+        return scalars(self, statement, *args, **kwargs)
+
+    monkeypatch.setattr(orm.Session, "scalars", lookup_before_other_login)
+    assert make_user() == other_logins[0]
+    with db.open_session(read_only=True) as session:
+        assert session.scalar(sqlalchemy.select(sqlalchemy.func.count(db.User.id))) == 1
+
+
+def test_get_or_create_user_reraises_other_integrity_errors() -> None:
+    with pytest.raises(sqlalchemy.exc.IntegrityError):
+        db.get_or_create_user("1@example.com", "google", {"sub": "1"})